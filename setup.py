@@ -31,6 +31,7 @@ setup(
         "ray[tune]",
         "ray",
         'numpy',
+        'scikit-learn',
         'urlextract',
         "transformers<=4.21.2",  # push-to-model is not working for latest version
         "huggingface-hub<=0.9.1",
@@ -0,0 +1,79 @@
+""" UnitTest """
+import os
+import unittest
+import logging
+import tempfile
+from unittest import mock
+
+from datasets.dataset_dict import DatasetDict
+from transformers import Trainer
+from transformers.trainer_utils import BestRun
+
+import tweetnlp
+from tweetnlp.text_classification.trainer import find_trial_checkpoint
+
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.DEBUG, datefmt='%Y-%m-%d %H:%M:%S')
+
+LANGUAGE_MODEL = 'cardiffnlp/twitter-roberta-base-dec2021'
+RUN_ID = 'a1b2c3d4'
+
+
+def make_trial_checkpoint(ray_result_dir: str, run_id: str, step: int):
+    """ mimic the directory layout of a ray tune trial checkpoint saved by the huggingface trainer """
+    path = os.path.join(
+        ray_result_dir, '_objective_2022-10-01', f'_objective_{run_id}_00000_0_learning_rate=0.0001',
+        f'checkpoint_{step:06d}', f'checkpoint-{step}')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class Test(unittest.TestCase):
+    """ Test """
+
+    def test_find_trial_checkpoint(self):
+        with tempfile.TemporaryDirectory() as ray_result_dir:
+            assert find_trial_checkpoint(ray_result_dir, RUN_ID) is None
+            make_trial_checkpoint(ray_result_dir, 'e5f6a7b8', 10)
+            assert find_trial_checkpoint(ray_result_dir, RUN_ID) is None
+            old = make_trial_checkpoint(ray_result_dir, RUN_ID, 10)
+            assert find_trial_checkpoint(ray_result_dir, RUN_ID) == old
+            new = make_trial_checkpoint(ray_result_dir, RUN_ID, 20)
+            os.utime(old, (0, 0))
+            assert find_trial_checkpoint(ray_result_dir, RUN_ID) == new
+
+    def test_train_with_best_trial_checkpoint(self):
+        dataset, label_to_id = tweetnlp.load_dataset("irony")
+        dataset = DatasetDict({k: v.select(list(range(16))) for k, v in dataset.items()})
+        with tempfile.TemporaryDirectory() as output_dir:
+            ray_result_dir = os.path.join(output_dir, 'ray_results')
+            trainer = tweetnlp.load_trainer("irony")(
+                language_model=LANGUAGE_MODEL,
+                dataset=dataset,
+                label_to_id=label_to_id,
+                split_train='train',
+                split_validation='validation',
+                split_test='test',
+                output_dir=output_dir
+            )
+
+            def hyperparameter_search(hf_trainer, *args, **kwargs):
+                # a trial saves its checkpoint, and ray leaves `trainer.model` unset after the search
+                model = hf_trainer.call_model_init()
+                model.save_pretrained(make_trial_checkpoint(ray_result_dir, RUN_ID, 10))
+                hf_trainer.model = None
+                return BestRun(RUN_ID, 1.0, {"learning_rate": 1e-5, "per_device_train_batch_size": 8})
+
+            with mock.patch.object(Trainer, 'hyperparameter_search', autospec=True,
+                                   side_effect=hyperparameter_search), \
+                    mock.patch.object(Trainer, 'train', autospec=True) as mock_train:
+                trainer.train(n_trials=1, ray_result_dir=ray_result_dir)
+            mock_train.assert_not_called()
+            assert trainer.model is not None
+            assert trainer.trainer.model is trainer.model
+            assert trainer.model.config.label2id == label_to_id, trainer.model.config.label2id
+            trainer.save_model()
+            assert os.path.exists(os.path.join(trainer.best_model_path, 'config.json'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,9 @@
+import copy
 import json
+import glob
+import hashlib
 import logging
 import os
-import math
 import shutil
 import multiprocessing
 from os.path import join as pj
@@ -9,11 +11,12 @@ from typing import Dict, List
 
 import torch
 import numpy as np
-from huggingface_hub import create_repo
-from datasets import load_metric
+from huggingface_hub import create_repo, HfApi, CommitOperationAdd
 from datasets.dataset_dict import DatasetDict
-from transformers import TrainingArguments, Trainer
+from transformers import TrainingArguments, Trainer, DataCollatorWithPadding, AutoModelForSequenceClassification
 from ray import tune
+from ray.tune.schedulers import PopulationBasedTraining
+from sklearn.metrics import precision_recall_fscore_support, accuracy_score
 
 from .model import Classifier
 from .readme_template import get_readme
@@ -23,6 +26,57 @@ from ..util import load_model
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
+def tokenize(batch, tokenizer, max_length):
+    return tokenizer(batch["text"], truncation=True, max_length=max_length)
+
+
+class DataCollatorMultiLabel(DataCollatorWithPadding):
+    """ `DataCollatorWithPadding` returning float labels, as expected by the multi-label (BCE) loss """
+
+    def __call__(self, features):
+        batch = super().__call__(features)
+        batch["labels"] = batch["labels"].float()
+        return batch
+
+
+def find_trial_checkpoint(ray_result_dir: str, run_id: str):
+    """ latest checkpoint saved by the ray tune trial `run_id` (None if the trial kept no checkpoint) """
+    checkpoints = glob.glob(pj(ray_result_dir, '**', f'*{run_id}*', 'checkpoint_*', 'checkpoint-*'), recursive=True)
+    if len(checkpoints) == 0:
+        return None
+    return max(checkpoints, key=os.path.getmtime)
+
+
+def get_accelerator_arguments(cpu_only: bool = False, num_workers: int = None):
+    """ mixed-precision and dataloader options for `TrainingArguments` given the available hardware """
+    cuda = torch.cuda.is_available() and not cpu_only
+    # native bf16 and tf32 need an Ampere or newer GPU (`torch.cuda.is_bf16_supported` also counts emulation)
+    bf16 = cuda and torch.cuda.get_device_capability()[0] >= 8
+    fp16 = cuda and not bf16
+    num_workers = min(8, os.cpu_count() // 2) if num_workers is None else num_workers
+    arguments = {
+        "bf16": bf16,
+        "fp16": fp16,
+        "tf32": bf16,
+        "dataloader_pin_memory": True,
+        "dataloader_num_workers": num_workers
+    }
+    # keep workers alive across epochs and prefetch batches ahead of the GPU (both options need workers, and were
+    # added to `TrainingArguments` in different transformers releases)
+    if num_workers > 0 and hasattr(TrainingArguments, "dataloader_persistent_workers"):
+        arguments["dataloader_persistent_workers"] = True
+    if num_workers > 0 and hasattr(TrainingArguments, "dataloader_prefetch_factor"):
+        arguments["dataloader_prefetch_factor"] = 4
+    if cpu_only:
+        arguments["no_cuda"] = True
+    elif cuda and hasattr(torch, "compile") and hasattr(TrainingArguments, "torch_compile"):
+        # let the Trainer wrap the model with `torch.compile` so that saving still works on the original module
+        # (default mode: the CUDA graphs of "reduce-overhead" would be re-captured for every padded length and
+        # batch size, while the default mode marks the varying dimensions dynamic after the first recompilation)
+        arguments["torch_compile"] = True
+    return arguments
+
+
 class TrainerTextClassification:
 
     def __init__(self,
@@ -66,10 +120,29 @@ class TrainerTextClassification:
             use_auth_token=self.use_auth_token,
             config_argument=self.model_config
         )
+        assert self.tokenizer.is_fast, f"fast tokenizer is not available for {self.language_model}"
+        self.initial_state_dict = None
         self.max_length = max_length
+        # tokenized splits are cached under output_dir keyed by the language model, max_length, and the dataset
+        # fingerprint, so that re-instantiating the trainer loads them via memory-mapping instead of re-tokenizing
+        cache_dir = pj(self.output_dir, 'tokenized_dataset_cache')
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_file_names = {}
+        for split in self.dataset.keys():
+            key = hashlib.md5(
+                f"{self.language_model}-{max_length}-dynamic_padding-{self.dataset[split]._fingerprint}".encode()).hexdigest()
+            cache_file_names[split] = pj(cache_dir, f"{split}.{key}.arrow")
         self.tokenized_datasets = self.dataset.map(
-            lambda x: self.tokenizer(x["text"], padding="max_length", truncation=True, max_length=max_length),
-            batched=True)
+            tokenize,
+            batched=True,
+            batch_size=1000,
+            fn_kwargs={"tokenizer": self.tokenizer, "max_length": max_length},
+            num_proc=multiprocessing.cpu_count(),
+            load_from_cache_file=True,
+            cache_file_names=cache_file_names)
+        # pad each batch to its longest sequence rather than padding every tweet to max_length
+        data_collator_class = DataCollatorMultiLabel if self.multi_label else DataCollatorWithPadding
+        self.data_collator = data_collator_class(self.tokenizer, pad_to_multiple_of=8)
         # setup metrics
         self.compute_metric_search, self.compute_metric_all = self.get_metrics()
         self.best_model_path = pj(self.output_dir, 'best_model')
@@ -80,6 +153,21 @@ class TrainerTextClassification:
         self.split_validation = split_validation
         self.trainer = None
         self.classifier = None
+        # whether `self.model` may be stale with respect to the fine-tuned model at `best_model_path`
+        self.model_needs_reload = True
+
+    def model_init(self, trial=None):
+        if self.initial_state_dict is None:
+            return load_model(
+                self.language_model,
+                return_dict=True,
+                task='sequence_classification',
+                use_auth_token=self.use_auth_token,
+                model_argument=dict(self.model_config)
+            )
+        model = AutoModelForSequenceClassification.from_config(self.config)
+        model.load_state_dict(self.initial_state_dict)
+        return model
 
     @property
     def export_file(self):
@@ -87,34 +175,31 @@ class TrainerTextClassification:
         return f"{self.output_dir}/metric.json"
 
     def get_metrics(self):
-        if self.multi_label:
-            metric_accuracy = load_metric("accuracy", "multilabel")
-            metric_f1 = load_metric("f1", "multilabel")
-        else:
-            metric_accuracy = load_metric("accuracy")
-            metric_f1 = load_metric("f1")
-
-        def sigmoid(x):
-            return 1 / (1 + math.exp(-x))
+        def get_predictions(logits):
+            logits = np.asarray(logits)
+            if not self.multi_label:
+                return np.argmax(logits, axis=-1)
+            # sigmoid(x) > 0.5 <=> x > 0, thresholded straight into a preallocated int8 buffer
+            predictions = np.empty(logits.shape, dtype=np.int8)
+            np.greater(logits, 0, out=predictions.view(np.bool_))
+            return predictions
 
         def compute_metric_search(eval_pred):
             logits, labels = eval_pred
-            if self.multi_label:
-                predictions = np.array([[int(sigmoid(j) > 0.5) for j in i] for i in logits])
-            else:
-                predictions = np.argmax(logits, axis=-1)
-            return metric_f1.compute(predictions=predictions, references=labels, average='micro')
+            predictions = get_predictions(logits)
+            _, _, f1_micro, _ = precision_recall_fscore_support(np.asarray(labels), predictions, average='micro')
+            return {'f1': float(f1_micro)}
 
         def compute_metric_all(eval_pred):
             logits, labels = eval_pred
-            if self.multi_label:
-                predictions = np.array([[int(sigmoid(j) > 0.5) for j in i] for i in logits])
-            else:
-                predictions = np.argmax(logits, axis=-1)
+            predictions = get_predictions(logits)
+            labels = np.asarray(labels)
+            _, _, f1_per_label, _ = precision_recall_fscore_support(labels, predictions, average=None)
+            _, _, f1_micro, _ = precision_recall_fscore_support(labels, predictions, average='micro')
             return {
-                'f1': metric_f1.compute(predictions=predictions, references=labels, average='micro')['f1'],
-                'f1_macro': metric_f1.compute(predictions=predictions, references=labels, average='macro')['f1'],
-                'accuracy': metric_accuracy.compute(predictions=predictions, references=labels)['accuracy']
+                'f1': float(f1_micro),
+                'f1_macro': float(f1_per_label.mean()),
+                'accuracy': float(accuracy_score(labels, predictions))
             }
 
         return compute_metric_search, compute_metric_all
@@ -127,9 +212,12 @@ class TrainerTextClassification:
               split_train: str = None,
               split_validation: str = None,
               parallel_cpu: bool = False,
+              gpus_per_trial: float = 1.0,
+              pbt_perturbation_interval: int = 2,
               search_range_lr: List = None,
               search_range_epoch: List = None,
               search_list_batch: List = None,
+              search_list_gradient_accumulation: List = None,
               ray_result_dir: str = 'ray_results',
               down_sample_size_train: int = None,
               down_sample_size_validation: int = None,
@@ -158,13 +246,17 @@ class TrainerTextClassification:
                     output_dir=self.output_dir,
                     evaluation_strategy="no",
                     eval_steps=eval_step,
-                    seed=random_seed
+                    seed=random_seed,
+                    gradient_checkpointing=True,
+                    **get_accelerator_arguments()
                 ) if training_arguments is None else training_arguments
             self.trainer = Trainer(
                 model=self.model,
                 args=training_arguments,
-                train_dataset=full_train_dataset
+                train_dataset=full_train_dataset,
+                data_collator=self.data_collator
             )
+            self.trainer.train()
         else:
             assert self.split_validation in self.dataset.keys(), \
                 f"validation split not found: {self.split_validation} is not in {self.dataset.keys()}"
@@ -173,39 +265,64 @@ class TrainerTextClassification:
                 tmp = self.tokenized_datasets[self.split_validation]
                 tmp = tmp.shuffle(random_seed)
                 self.tokenized_datasets[self.split_validation] = tmp.select(list(range(down_sample_size_validation)))
-
+            # a fractional `gpus_per_trial` (eg. 0.5) lets several trials share a GPU and run concurrently, while
+            # the trainer needs an integer number of GPUs to compute its batch size otherwise
+            if gpus_per_trial >= 1:
+                assert float(gpus_per_trial).is_integer(), \
+                    f"gpus_per_trial should be an integer or a fraction below 1: {gpus_per_trial}"
+                gpus_per_trial = int(gpus_per_trial)
+            resources_per_trial = {
+                'cpu': multiprocessing.cpu_count() if parallel_cpu else 1,
+                "gpu": gpus_per_trial if torch.cuda.is_available() else 0
+            }
+            # load the pretrained weights once (`self.model` may already be fine-tuned by an earlier `train` or
+            # `evaluate`) and keep them on CPU to instantiate a fresh model for each trial without reloading the
+            # checkpoint (released once the search and the final fine-tuning are done)
+            self.initial_state_dict = {k: v.detach().cpu() for k, v in load_model(
+                self.language_model,
+                return_dict=True,
+                task='sequence_classification',
+                use_auth_token=self.use_auth_token,
+                model_argument=dict(self.model_config)
+            ).state_dict().items()}
             self.trainer = Trainer(
                 model=self.model,
                 args=TrainingArguments(
                     output_dir=self.output_dir,
                     evaluation_strategy="steps",
                     eval_steps=eval_step,
-                    seed=random_seed
+                    # ray tune keeps a trial checkpoint only at evaluations that coincide with a save, so save at
+                    # every evaluation to reuse the best trial's checkpoint after the search
+                    save_strategy="steps",
+                    save_steps=eval_step,
+                    seed=random_seed,
+                    gradient_checkpointing=True,
+                    # trials run concurrently, so the dataloader workers share the cpus ray reserves for a trial
+                    **get_accelerator_arguments(num_workers=min(8, resources_per_trial['cpu'] - 1))
                 ),
                 train_dataset=search_train_dataset,
                 eval_dataset=self.tokenized_datasets[self.split_validation],
                 compute_metrics=self.compute_metric_search,
-                model_init=lambda x: load_model(
-                    self.language_model,
-                    return_dict=True,
-                    task='sequence_classification',
-                    use_auth_token=self.use_auth_token,
-                    model_argument=self.model_config,
-                )
+                data_collator=self.data_collator,
+                model_init=self.model_init
             )
             # define search space
             logging.info('define search space')
+            assert pbt_perturbation_interval >= 1 and float(pbt_perturbation_interval).is_integer(), \
+                f"pbt_perturbation_interval should be a positive number of evaluations: {pbt_perturbation_interval}"
             search_range_lr = [1e-6, 1e-4] if search_range_lr is None else search_range_lr
             assert len(search_range_lr) == 2, f"len(search_range_lr) should be 2: {search_range_lr}"
             search_range_epoch = [1, 6] if search_range_epoch is None else search_range_epoch
             assert len(search_range_epoch) == 2, f"len(search_range_epoch) should be 2: {search_range_epoch}"
-            search_list_batch = [4, 8, 16, 32, 64] if search_list_batch is None else search_list_batch
+            search_list_batch = [8, 16, 32, 64] if search_list_batch is None else search_list_batch
+            search_list_gradient_accumulation = [1, 2, 4] if search_list_gradient_accumulation is None \
+                else search_list_gradient_accumulation
             search_space = {
                 "learning_rate": tune.loguniform(search_range_lr[0], search_range_lr[1]),
                 "num_train_epochs": tune.choice(list(range(search_range_epoch[0], search_range_epoch[1]))),
-                "per_device_train_batch_size": tune.choice(search_list_batch)
+                "per_device_train_batch_size": tune.choice(search_list_batch),
+                "gradient_accumulation_steps": tune.choice(search_list_gradient_accumulation)
             }
-            resources_per_trial = {'cpu': multiprocessing.cpu_count() if parallel_cpu else 1, "gpu": torch.cuda.device_count()}
             logging.info(f'run on `{resources_per_trial["cpu"]}` cpus and `{resources_per_trial["gpu"]}` gpus')
             # run parameter search
             logging.info("start parameter search")
@@ -215,19 +332,51 @@ class TrainerTextClassification:
                 direction="maximize",
                 backend="ray",
                 n_trials=n_trials,
-                resources_per_trial=resources_per_trial
+                resources_per_trial=resources_per_trial,
+                # population-based training: periodically replace the weaker trials by perturbed copies of the
+                # stronger ones. a training iteration is one evaluation (every `eval_step` steps) and each one
+                # writes a checkpoint (`save_steps=eval_step`), so every perturbation has a checkpoint to exploit
+                scheduler=PopulationBasedTraining(
+                    time_attr="training_iteration",
+                    metric="eval_f1",
+                    mode="max",
+                    perturbation_interval=pbt_perturbation_interval,
+                    hyperparam_mutations={
+                        "learning_rate": tune.loguniform(search_range_lr[0], search_range_lr[1]),
+                        "per_device_train_batch_size": search_list_batch
+                    }
+                ),
+                keep_checkpoints_num=1,
+                checkpoint_score_attr="eval_f1"
             )
-            # finetuning with the best config
             with open(self.best_run_hyperparameters_path, 'w') as f:
                 json.dump(best_run.hyperparameters, f)
-            logging.info(f"fine-tuning with the best config: {best_run} (saved at {self.best_run_hyperparameters_path})")
             for n, v in best_run.hyperparameters.items():
                 setattr(self.trainer.args, n, v)
+            # the best trial was already trained on the full training set unless it was down-sampled for the
+            # search, so reuse its checkpoint rather than fine-tuning again with the best config
+            best_checkpoint = None
+            if search_train_dataset is full_train_dataset:
+                best_checkpoint = find_trial_checkpoint(ray_result_dir, best_run.run_id)
             setattr(self.trainer, "train_dataset", full_train_dataset)
-            setattr(self.trainer.args, "evaluation_strategy", 'no')
-        self.trainer.train()
+            if best_checkpoint is not None:
+                logging.info(f"load the best trial checkpoint: {best_checkpoint} "
+                             f"(config saved at {self.best_run_hyperparameters_path})")
+                # ray instantiates the models inside its trials and `hyperparameter_search` leaves `trainer.model`
+                # as None, so the best model is loaded from the checkpoint
+                self.trainer.model = AutoModelForSequenceClassification.from_pretrained(best_checkpoint)
+                self.trainer.model_wrapped = self.trainer.model
+            else:
+                # finetuning with the best config
+                logging.info(f"fine-tuning with the best config: {best_run} "
+                             f"(saved at {self.best_run_hyperparameters_path})")
+                setattr(self.trainer.args, "evaluation_strategy", 'no')
+                # `Trainer.train` re-initializes the model with `model_init`, so the initial weights are still needed
+                self.trainer.train()
+            self.initial_state_dict = None
         logging.info('training finished')
         self.model = self.trainer.model
+        self.model_needs_reload = False
 
     def predict(self,
                 text: str or List,
@@ -252,7 +401,7 @@ class TrainerTextClassification:
         self.tokenizer.save_pretrained(self.best_model_path)
         logging.info(f"best model saved at {self.best_model_path}")
 
-    def evaluate(self, split_test: str = None, output_dir: str = None):
+    def evaluate(self, split_test: str = None, output_dir: str = None, int8: bool = False):
         if self.trainer is None:
             logging.warning("model is not trained.")
         if output_dir is not None:
@@ -263,20 +412,42 @@ class TrainerTextClassification:
         assert self.split_test is not None and self.split_test in self.dataset.keys(), \
             f"test split not found: {self.split_test} is not in {self.dataset.keys()}"
         logging.info('model evaluation')
-        # self.model = load_model(
-        #     model=self.language_model if not os.path.exists(self.best_model_path) else self.best_model_path,
-        #     model_only=True,
-        #     task='sequence_classification',
-        #     use_auth_token=self.use_auth_token,
-        #     model_argument=self.model_config
-        # )
+        if self.model_needs_reload and os.path.exists(self.best_model_path):
+            # standalone evaluation of a saved model (the fine-tuned model is kept in memory after `train`)
+            logging.info(f'load model from {self.best_model_path}')
+            self.model = load_model(
+                self.best_model_path,
+                model_only=True,
+                task='sequence_classification',
+                use_auth_token=self.use_auth_token,
+                model_argument=self.model_config
+            )
+            self.model_needs_reload = False
+            self.classifier = None
+        # sort by length so that each batch holds similar-length tweets and dynamic padding adds few pad tokens
+        # (metrics are order-invariant, and the Trainer's evaluation sampler does not support `group_by_length`)
+        eval_dataset = self.tokenized_datasets[self.split_test].map(
+            lambda x: {"length": [len(i) for i in x["input_ids"]]}, batched=True).sort("length")
+        model = self.model
+        if int8:
+            # dynamic int8 quantization of the linear layers on a full-precision CPU copy, so `self.model` keeps its
+            # device and dtype (quantized kernels run on CPU only)
+            logging.info('evaluate with int8 dynamic quantization on CPU')
+            model = torch.quantization.quantize_dynamic(
+                copy.deepcopy(self.model).float().cpu(), {torch.nn.Linear}, dtype=torch.qint8)
         trainer = Trainer(
-            model=self.model,
-            args=TrainingArguments(output_dir=self.output_dir, evaluation_strategy="no"),
-            eval_dataset=self.tokenized_datasets[self.split_test],
-            compute_metrics=self.compute_metric_all
+            model=model,
+            args=TrainingArguments(
+                output_dir=self.output_dir,
+                evaluation_strategy="no",
+                # evaluation runs under autocast with bf16/fp16; `*_full_eval` would cast `self.model` in place
+                **get_accelerator_arguments(cpu_only=int8)
+            ),
+            eval_dataset=eval_dataset,
+            compute_metrics=self.compute_metric_all,
+            data_collator=self.data_collator
         )
-        result = {k: v for k, v in trainer.evaluate().items()}
+        result = trainer.evaluate()
         logging.info(json.dumps(result, indent=4))
         with open(self.export_file, 'w') as f:
             json.dump(result, f)
@@ -307,10 +478,12 @@ class TrainerTextClassification:
         if split_test is not None:
             self.split_test = split_test
         logging.info('uploading to huggingface')
-        url = create_repo(model_alias, organization=hf_organization, exist_ok=True)
-        args = {"use_auth_token": self.use_auth_token, "repo_url": url, "organization": hf_organization}
-        self.model.push_to_hub(model_alias, **args)
-        self.tokenizer.push_to_hub(model_alias, **args)
+        create_repo(model_alias, organization=hf_organization, exist_ok=True)
+        # model, tokenizer, and model card are written locally and uploaded together in a single commit over HTTP
+        # (no git clone of the model repository is involved)
+        os.makedirs(model_alias, exist_ok=True)
+        self.model.save_pretrained(model_alias)
+        self.tokenizer.save_pretrained(model_alias)
         readme = get_readme(
             model_name=f"{hf_organization}/{model_alias}",
             metric_file=self.export_file,
@@ -325,5 +498,13 @@ class TrainerTextClassification:
             f.write(readme)
         if os.path.exists(self.best_run_hyperparameters_path):
             shutil.copy2(self.best_run_hyperparameters_path, pj(model_alias, 'best_run_hyperparameters.json'))
-        os.system(
-            f"cd {model_alias} && git lfs install && git add . && git commit -m 'model update' && git push && cd ../")
+        operations = [
+            CommitOperationAdd(path_in_repo=i, path_or_fileobj=pj(model_alias, i)) for i in sorted(os.listdir(model_alias))
+            if not i.startswith('.') and os.path.isfile(pj(model_alias, i))
+        ]
+        HfApi().create_commit(
+            repo_id=f"{hf_organization}/{model_alias}",
+            operations=operations,
+            commit_message="model update",
+            token=self.use_auth_token if isinstance(self.use_auth_token, str) else None
+        )
@@ -82,6 +82,7 @@ def load_model(model: str,
 
     tokenizer_argument = {} if tokenizer_argument is None else tokenizer_argument
     tokenizer_argument.update({"use_auth_token": use_auth_token, "local_files_only": no_network})
+    tokenizer_argument.setdefault("use_fast", True)
     tokenizer = AutoTokenizer.from_pretrained(model, **tokenizer_argument)
 
     model_argument.update({"config": config})